@@ -1,15 +1,105 @@
 import zmq
 import threading
 import time
-import queue
-import json
 import os
+import errno
+import itertools
+import struct
+from collections import deque
+import numpy as np
+from protocol import DISTRIBUTE_HEADER, COLLECT_HEADER, READY, READY_HEADER, ipc_endpoint, ipc_path
+
+# Perfetto protobuf field numbers (see perfetto/protos/perfetto/trace/)
+TRACE_PACKET = 1  # Trace.packet
+PACKET_TIMESTAMP = 8  # TracePacket.timestamp
+PACKET_SEQUENCE_ID = 10  # TracePacket.trusted_packet_sequence_id
+PACKET_TRACK_EVENT = 11  # TracePacket.track_event
+PACKET_TRACK_DESCRIPTOR = 60  # TracePacket.track_descriptor
+TRACK_UUID = 1  # TrackDescriptor.uuid
+TRACK_NAME = 2  # TrackDescriptor.name
+TRACK_PROCESS = 3  # TrackDescriptor.process
+TRACK_PARENT_UUID = 5  # TrackDescriptor.parent_uuid
+TRACK_COUNTER = 8  # TrackDescriptor.counter
+PROCESS_PID = 1  # ProcessDescriptor.pid
+PROCESS_NAME = 6  # ProcessDescriptor.process_name
+EVENT_ANNOTATIONS = 4  # TrackEvent.debug_annotations
+EVENT_TYPE = 9  # TrackEvent.type
+EVENT_TRACK_UUID = 11  # TrackEvent.track_uuid
+EVENT_CATEGORIES = 22  # TrackEvent.categories
+EVENT_NAME = 23  # TrackEvent.name
+EVENT_DOUBLE_COUNTER_VALUE = 44  # TrackEvent.double_counter_value
+ANNOTATION_INT = 4  # DebugAnnotation.int_value
+ANNOTATION_STRING = 6  # DebugAnnotation.string_value
+ANNOTATION_NAME = 10  # DebugAnnotation.name
+TYPE_SLICE_BEGIN = 1
+TYPE_SLICE_END = 2
+TYPE_INSTANT = 3
+TYPE_COUNTER = 4
+TRACE_SEQUENCE_ID = 1
+COUNTER_TRACK_UUID_BASE = 1 << 32  # Above any pid, so counter tracks never collide with process tracks
+
+# Frame timing records, stored as preallocated per-field columns so logging never builds Python objects.
+# The columns are rings: once full, each new record overwrites the oldest, bounding memory and export time.
+FRAME_TIMING_COLUMNS = (
+    ('frame_index', np.int32),
+    ('begin_ns', np.int64),
+    ('end_ns', np.int64),
+    ('pid', np.int32),
+    ('ph', np.uint8),  # PH_INSTANT or PH_COMPLETE
+    ('event_type', np.uint8)  # Index into Distributor.event_types
+)
+FRAME_TIMING_CAPACITY = 1 << 20
+THREAD_JOIN_TIMEOUT = 1.0  # Seconds to wait for each thread to leave its loop at shutdown
+PH_INSTANT = 0
+PH_COMPLETE = 1
+
+# Sampled counters (FPS, queue depth, drops), rendered by Perfetto as counter tracks
+COUNTER_COLUMNS = (
+    ('counter', np.uint8),  # Index into Distributor.event_types
+    ('timestamp_ns', np.int64),
+    ('value', np.float64)
+)
+COUNTER_CAPACITY = 1 << 16
+
+def _ring_records(columns, total, capacity):
+    """Return ring columns oldest-first, given the number of records ever written, and the record count"""
+    if total <= capacity:
+        return {name: column[:total] for name, column in columns.items()}, total
+    shift = -(total % capacity)
+    return {name: np.roll(column, shift) for name, column in columns.items()}, capacity
+
+def _pb_varint(value):
+    """Encode an integer as a protobuf varint (negative values as 64-bit two's complement)"""
+    value &= 0xFFFFFFFFFFFFFFFF
+    out = bytearray()
+    while value > 0x7F:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+def _pb_int(field, value):
+    """Encode a varint field"""
+    return _pb_varint(field << 3) + _pb_varint(value)
+
+def _pb_bytes(field, data):
+    """Encode a length-delimited field (bytes, string or nested message)"""
+    if isinstance(data, str):
+        data = data.encode()
+    return _pb_varint((field << 3) | 2) + _pb_varint(len(data)) + data
+
+def _pb_double(field, value):
+    """Encode a double field"""
+    return _pb_varint((field << 3) | 1) + struct.pack('<d', value)
+
+def _pb_annotation(name, value):
+    """Encode a DebugAnnotation with an int or string value"""
+    if isinstance(value, str):
+        return _pb_bytes(ANNOTATION_NAME, name) + _pb_bytes(ANNOTATION_STRING, value)
+    return _pb_bytes(ANNOTATION_NAME, name) + _pb_int(ANNOTATION_INT, value)
 
 class Distributor:
     def __init__(self, distribute_port=5555, collect_port=5556, frame_delay=5, enable_trace_export=False):
-        # Frame processing queue
-        self.frame_queue = queue.Queue(maxsize=10)
-        
         # Frame index counter
         self.frame_index_counter = 0
         
@@ -17,231 +107,333 @@ class Distributor:
         self.last_frame_sent = -1
         
         # Frame reordering system
-        self.received_frames = {}  # Dictionary to store received frames by index
         self.current_display_frame = 0  # Current frame being displayed
+        self.displayed_frame_index = -1  # Ring frame last handed out by get_frame_to_display
         self.latest_received_frame = -1  # Latest frame index received from workers
+        self.display_ready_frame = -1  # Newest held frame at or before the display target, kept by the distribute thread
+        self.display_target_scanned = -1  # Highest display target whose preceding slots have been checked
         self.frame_buffer_size = 50  # Maximum number of frames to keep in buffer
         self.frame_delay = frame_delay  # Number of frames to delay display
         
-        # Initialize ZeroMQ context and sockets
-        self.context = zmq.Context()
+        # Fixed-size ring of received frames, slot = frame_index % ring_size
+        self.ring_size = self.frame_buffer_size + self.frame_delay
+        self.frame_ring = [None] * self.ring_size  # Raw payload per slot
+        self.frame_ring_index = [-1] * self.ring_size  # Frame index held by each slot
+        
+        # Initialize ZeroMQ context and sockets; a second I/O thread for fanning raw frames out to many workers
+        self.context = zmq.Context(io_threads=2)
+        self.context.setsockopt(zmq.LINGER, 0)  # Applies to every socket below: frames are worthless once we close
         
         # ROUTER socket to handle client requests and send frames
         self.distribute_socket = self.context.socket(zmq.ROUTER)
+        self.distribute_socket.setsockopt(zmq.SNDHWM, 1)  # At most one queued frame per worker; stale extras are dropped
+        self.distribute_socket.setsockopt(zmq.ROUTER_MANDATORY, 1)  # Report unreachable workers instead of silently dropping
         self.distribute_socket.bind(f"tcp://*:{distribute_port}")
+        self.ipc_available = zmq.has("ipc")
+        self._bind_ipc(self.distribute_socket, distribute_port)  # For workers on this host
         
         # PULL socket to receive inverted frames from inverter
         self.collect_socket = self.context.socket(zmq.PULL)
+        self.collect_socket.setsockopt(zmq.RCVHWM, 4)
         self.collect_socket.bind(f"tcp://*:{collect_port}")
+        self._bind_ipc(self.collect_socket, collect_port)
+        
+        # Inproc PAIR sockets to hand captured frames to the distribute thread
+        self.feed_in = self.context.socket(zmq.PAIR)
+        self.feed_in.bind("inproc://feed")
+        self.feed_out = self.context.socket(zmq.PAIR)
+        self.feed_out.setsockopt(zmq.SNDHWM, 10)
+        self.feed_out.connect("inproc://feed")
+        
+        # Single poller so one thread wakes on new frames, client requests or inverted frames
+        self.distribute_poller = zmq.Poller()
+        self.distribute_poller.register(self.distribute_socket, zmq.POLLIN)
+        self.distribute_poller.register(self.feed_in, zmq.POLLIN)
+        self.distribute_poller.register(self.collect_socket, zmq.POLLIN)
+        
+        # Latest frame waiting to be handed to a worker
+        self.current_frame_data = None
+        
+        # Workers that sent READY while no new frame was available, served first-come first-served
+        self.idle_workers = deque()
+        self.frames_sent_to = {}  # Frames sent per worker, to tell a resent READY from a new credit
         
         # Frame timing tracking
         self.enable_trace_export = enable_trace_export
-        self.frame_timings = []
-        self.trace_start_time = time.time()
+        self.frame_timing_capacity = FRAME_TIMING_CAPACITY if enable_trace_export else 0
+        self.frame_timings = {name: np.zeros(self.frame_timing_capacity, dtype=dtype) for name, dtype in FRAME_TIMING_COLUMNS}
+        self.frame_timing_slots = itertools.count()  # next() is atomic under the GIL, so threads never share a slot
+        self.event_types = []  # Event type and counter names, stored by index in the timing and counter records
+        self.event_type_ids = {}
+        self.event_type_lock = threading.Lock()  # Only taken the first time an event type is seen
+        self.counter_capacity = COUNTER_CAPACITY if enable_trace_export else 0
+        self.counters = {name: np.zeros(self.counter_capacity, dtype=dtype) for name, dtype in COUNTER_COLUMNS}
+        self.counter_slots = itertools.count()
+        
+        # Frames the distribute thread could not accept in time
+        self.frames_dropped = 0
+        self.process_id = os.getpid()
         
         # Threading
         self.running = False
         
-        # Start distribute handling thread
+        # Start the socket thread (distributes frames and collects inverted output)
         self.distribute_thread = threading.Thread(target=self.handle_distribute_requests)
         self.distribute_thread.daemon = True
-        
-        # Start inverter output checking thread
-        self.inverter_thread = threading.Thread(target=self.check_inverter_output)
-        self.inverter_thread.daemon = True
+    
+    def _bind_ipc(self, socket, port):
+        """Also bind a socket to its ipc endpoint, staying tcp-only if that fails (e.g. on Windows)"""
+        # The tcp bind on this port just succeeded, so no live distributor owns it: a socket file left by a
+        # crashed run is stale, and must not steer new workers to a dead endpoint even if ipc is unavailable
+        try:
+            os.remove(ipc_path(port))
+        except OSError:
+            pass
+        if not self.ipc_available:
+            return
+        try:
+            socket.bind(ipc_endpoint(port))
+        except zmq.ZMQError as e:
+            print(f"ipc endpoints unavailable ({e}), local workers will connect over tcp")
+            self.ipc_available = False
     
     def start(self):
         """Start all distributor threads"""
         self.running = True
         self.distribute_thread.start()
-        self.inverter_thread.start()
     
     def stop(self):
         """Stop all distributor threads"""
         self.running = False
     
-    def log_frame_timing(self, frame_index, timestamp, event_type="frame_captured"):
-        """Log frame timing event for Perfetto trace"""
+    def _join_thread(self, thread):
+        """Wait for a stopping thread to exit, since zmq sockets must not be closed under a thread still using them"""
+        if thread is threading.current_thread() or not thread.is_alive():
+            return
+        thread.join(THREAD_JOIN_TIMEOUT)
+        if thread.is_alive():
+            print(f"Warning: {thread.name} did not stop within {THREAD_JOIN_TIMEOUT}s")
+    
+    def log_frame_timing(self, frame_index, timestamp_ns, event_type="frame_captured"):
+        """Log frame timing event for Perfetto trace (timestamp in nanoseconds)"""
         if not self.enable_trace_export:
             return
-        self.frame_timings.append({
-            'frame_index': frame_index,
-            'timestamp': timestamp,
-            'event_type': event_type,
-            'relative_time': timestamp - self.trace_start_time,
-            'event_ph': 'i'  # Instant event
-        })
+        if timestamp_ns is None:
+            timestamp_ns = time.time_ns()
+        self._log_timing_record(frame_index, timestamp_ns, timestamp_ns, self.process_id, PH_INSTANT, event_type)
     
-    def log_frame_complete_timing(self, frame_index, begin_time, end_time, event_type="frame_processed", pid=None):
-        """Log frame timing as complete event with duration"""
+    def log_frame_complete_timing(self, frame_index, begin_ns, end_ns, event_type="frame_processed", pid=None):
+        """Log frame timing as complete event with duration (timestamps in nanoseconds)"""
         if not self.enable_trace_export:
             return
-        self.frame_timings.append({
-            'frame_index': frame_index,
-            'begin_time': begin_time,
-            'end_time': end_time,
-            'event_type': event_type,
-            'begin_relative_time': begin_time - self.trace_start_time,
-            'end_relative_time': end_time - self.trace_start_time,
-            'event_ph': 'X',  # Complete event
-            'pid': pid
-        })
+        if pid is None:
+            pid = self.process_id
+        self._log_timing_record(frame_index, begin_ns, end_ns, pid, PH_COMPLETE, event_type)
+    
+    def _log_timing_record(self, frame_index, begin_ns, end_ns, pid, ph, event_type):
+        """Store one timing record in the preallocated columns"""
+        i = next(self.frame_timing_slots) % self.frame_timing_capacity
+        event_type_id = self._event_type_id(event_type)
+        timings = self.frame_timings
+        timings['frame_index'][i] = frame_index
+        timings['begin_ns'][i] = begin_ns
+        timings['end_ns'][i] = end_ns
+        timings['pid'][i] = pid
+        timings['ph'][i] = ph
+        timings['event_type'][i] = event_type_id
+    
+    def log_counter(self, name, value, timestamp_ns=None):
+        """Record a sample of a named counter for Perfetto trace"""
+        if not self.enable_trace_export:
+            return
+        if timestamp_ns is None:
+            timestamp_ns = time.time_ns()
+        i = next(self.counter_slots) % self.counter_capacity
+        counters = self.counters
+        counters['counter'][i] = self._event_type_id(name)
+        counters['timestamp_ns'][i] = timestamp_ns
+        counters['value'][i] = value
+    
+    def _event_type_id(self, event_type):
+        """Return the interned index of an event type or counter name"""
+        event_type_id = self.event_type_ids.get(event_type)
+        if event_type_id is None:
+            with self.event_type_lock:
+                event_type_id = self.event_type_ids.get(event_type)
+                if event_type_id is None:
+                    self.event_types.append(event_type)
+                    event_type_id = self.event_type_ids[event_type] = len(self.event_types) - 1
+        return event_type_id
     
     def export_perfetto_trace(self):
         """Export frame timing data to Perfetto trace format"""
         if not self.enable_trace_export:
             print("Trace export is disabled")
             return
-        if not self.frame_timings:
+        # Reserving one more slot gives the number already handed out
+        timings, count = _ring_records(self.frame_timings, next(self.frame_timing_slots), self.frame_timing_capacity)
+        counters, counter_count = _ring_records(self.counters, next(self.counter_slots), self.counter_capacity)
+        if count == 0 and counter_count == 0:
             print("No frame timing data to export")
             return
         
         # Create trace file
         trace_file = "webcam_frame_timing.pftrace"
         
-        # Write trace data in Perfetto format
-        with open(trace_file, 'w') as f:
-            f.write('{\n')
-            f.write('  "traceEvents": [\n')
+        # Build Perfetto TracePackets: one process track for the distributor and one per worker
+        distributor_pid = self.process_id
+        track_names = {distributor_pid: "distributor"}
+        events = []  # (timestamp_ns, order, TrackEvent bytes); slice ends sort before begins at equal ts
+        
+        rows = zip(*(timings[name].tolist() for name, _ in FRAME_TIMING_COLUMNS))
+        for frame_index, begin_ns, end_ns, pid, ph, event_type_id in rows:
+            event_type = self.event_types[event_type_id]
+            name = f"Frame {frame_index} - {event_type}"
+            annotations = (
+                _pb_bytes(EVENT_ANNOTATIONS, _pb_annotation("frame_index", frame_index)) +
+                _pb_bytes(EVENT_ANNOTATIONS, _pb_annotation("event_type", event_type))
+            )
+            if ph == PH_INSTANT:  # Instant event
+                track_event = (
+                    _pb_int(EVENT_TYPE, TYPE_INSTANT) +
+                    _pb_int(EVENT_TRACK_UUID, distributor_pid) +
+                    _pb_bytes(EVENT_CATEGORIES, "video_frames") +
+                    _pb_bytes(EVENT_NAME, name) +
+                    annotations
+                )
+                events.append((begin_ns, 1, track_event))
+            else:  # Complete event, written as a begin/end slice pair
+                track_names.setdefault(pid, f"worker {pid}")
+                begin_event = (
+                    _pb_int(EVENT_TYPE, TYPE_SLICE_BEGIN) +
+                    _pb_int(EVENT_TRACK_UUID, pid) +
+                    _pb_bytes(EVENT_NAME, name) +
+                    annotations
+                )
+                end_event = _pb_int(EVENT_TYPE, TYPE_SLICE_END) + _pb_int(EVENT_TRACK_UUID, pid)
+                events.append((begin_ns, 1, begin_event))
+                events.append((end_ns, 0, end_event))
+        
+        # Counter samples, one track per counter under the distributor process
+        counter_ids = set()
+        for counter_id, timestamp_ns, value in zip(*(counters[name].tolist() for name, _ in COUNTER_COLUMNS)):
+            counter_ids.add(counter_id)
+            counter_event = (
+                _pb_int(EVENT_TYPE, TYPE_COUNTER) +
+                _pb_int(EVENT_TRACK_UUID, COUNTER_TRACK_UUID_BASE + counter_id) +
+                _pb_double(EVENT_DOUBLE_COUNTER_VALUE, value)
+            )
+            events.append((timestamp_ns, 1, counter_event))
+        
+        events.sort(key=lambda event: event[:2])
+        
+        # Write trace data in Perfetto protobuf format
+        with open(trace_file, 'wb') as f:
+            for pid, track_name in track_names.items():
+                process = _pb_int(PROCESS_PID, pid) + _pb_bytes(PROCESS_NAME, track_name)
+                track = _pb_int(TRACK_UUID, pid) + _pb_bytes(TRACK_NAME, track_name) + _pb_bytes(TRACK_PROCESS, process)
+                packet = _pb_bytes(PACKET_TRACK_DESCRIPTOR, track) + _pb_int(PACKET_SEQUENCE_ID, TRACE_SEQUENCE_ID)
+                f.write(_pb_bytes(TRACE_PACKET, packet))
             
-            for i, timing in enumerate(self.frame_timings):
-                if timing['event_ph'] == 'i':  # Instant event
-                    event = {
-                        "name": f"Frame {timing['frame_index']} - {timing['event_type']}",
-                        "cat": "video_frames",
-                        "ph": "i",  # Instant event
-                        "ts": int(timing['relative_time'] * 1000000),  # Convert to microseconds
-                        "pid": os.getpid(),
-                        "tid": threading.get_ident(),
-                        "args": {
-                            "frame_index": timing['frame_index'],
-                            "event_type": timing['event_type'],
-                            "absolute_timestamp": timing['timestamp']
-                        }
-                    }
-                else:  # Complete event
-                    duration = timing['end_relative_time'] - timing['begin_relative_time']
-                    event = {
-                        "name": f"Frame {timing['frame_index']} - {timing['event_type']}",
-                        "ph": "X",  # Complete event
-                        "ts": int(timing['begin_relative_time'] * 1000000),  # Convert to microseconds
-                        "dur": int(duration * 1000000),  # Duration in microseconds
-                        "pid": timing.get('pid', os.getpid()),
-                        "tid": threading.get_ident(),
-                        "args": {
-                            "frame_index": timing['frame_index'],
-                            "event_type": timing['event_type'],
-                            "begin_timestamp": timing['begin_time'],
-                            "end_timestamp": timing['end_time'],
-                            "duration_ms": duration * 1000
-                        }
-                    }
-                
-                f.write('    ' + json.dumps(event))
-                if i < len(self.frame_timings) - 1:
-                    f.write(',')
-                f.write('\n')
+            for counter_id in sorted(counter_ids):
+                track = (
+                    _pb_int(TRACK_UUID, COUNTER_TRACK_UUID_BASE + counter_id) +
+                    _pb_bytes(TRACK_NAME, self.event_types[counter_id]) +
+                    _pb_int(TRACK_PARENT_UUID, distributor_pid) +
+                    _pb_bytes(TRACK_COUNTER, b"")
+                )
+                packet = _pb_bytes(PACKET_TRACK_DESCRIPTOR, track) + _pb_int(PACKET_SEQUENCE_ID, TRACE_SEQUENCE_ID)
+                f.write(_pb_bytes(TRACE_PACKET, packet))
             
-            f.write('  ]\n')
-            f.write('}\n')
+            for timestamp, _, track_event in events:
+                packet = (
+                    _pb_int(PACKET_TIMESTAMP, timestamp) +
+                    _pb_int(PACKET_SEQUENCE_ID, TRACE_SEQUENCE_ID) +
+                    _pb_bytes(PACKET_TRACK_EVENT, track_event)
+                )
+                f.write(_pb_bytes(TRACE_PACKET, packet))
         
         print(f"Perfetto trace exported to: {trace_file}")
-        print(f"Total frames logged: {len(self.frame_timings)}")
+        print(f"Total frames logged: {count}")
+        print(f"Total counter samples: {counter_count}")
         
-        # Print timing statistics
-        if self.frame_timings:
-            # Separate instant and complete events for statistics
-            instant_events = [t for t in self.frame_timings if t['event_ph'] == 'i']
-            complete_events = [t for t in self.frame_timings if t['event_ph'] == 'X']
-            
-            if instant_events:
-                timestamps = [t['timestamp'] for t in instant_events]
-                intervals = [timestamps[i+1] - timestamps[i] for i in range(len(timestamps)-1)]
-                if intervals:
-                    avg_interval = sum(intervals) / len(intervals)
-                    print(f"Average frame capture interval: {avg_interval*1000:.2f}ms")
-                    print(f"Frame capture rate: {1/avg_interval:.1f} FPS")
-            
-            if complete_events:
-                durations = [(t['end_time'] - t['begin_time']) for t in complete_events]
-                if durations:
-                    avg_duration = sum(durations) / len(durations)
-                    print(f"Average processing duration: {avg_duration*1000:.2f}ms")
-                    print(f"Processing rate: {1/avg_duration:.1f} FPS")
-                    print(f"Total frames processed: {len(complete_events)}")
+        # Print timing statistics, vectorised over the columns
+        instant = timings['ph'] == PH_INSTANT
+        complete = timings['ph'] == PH_COMPLETE
+        
+        if instant.sum() > 1:
+            avg_interval = np.diff(timings['begin_ns'][instant]).mean() / 1e9
+            print(f"Average frame capture interval: {avg_interval*1000:.2f}ms")
+            print(f"Frame capture rate: {1/avg_interval:.1f} FPS")
+        
+        if complete.any():
+            avg_duration = (timings['end_ns'][complete] - timings['begin_ns'][complete]).mean() / 1e9
+            print(f"Average processing duration: {avg_duration*1000:.2f}ms")
+            print(f"Processing rate: {1/avg_duration:.1f} FPS")
+            print(f"Total frames processed: {complete.sum()}")
     
-    def add_frame_for_distribution(self, frame, timestamp=None):
+    def add_frame_for_distribution(self, frame, timestamp_ns=None):
         """Add a frame to the distribution queue with automatic frame indexing"""
-        if timestamp is None:
-            timestamp = time.time()
-        
         # Increment frame index counter
         frame_index = self.frame_index_counter
         self.frame_index_counter += 1
         
         try:
-            frame_data = {
-                'frame': frame,
-                'frame_index': frame_index,
-                'timestamp': timestamp
-            }
-            self.frame_queue.put_nowait(frame_data)
+            # Copied on send (the default), so the caller may reuse its buffer as soon as this returns
+            self.feed_out.send_multipart([DISTRIBUTE_HEADER.pack(frame_index), frame], zmq.NOBLOCK)
             
             # Log frame timing for Perfetto trace
-            self.log_frame_timing(frame_index, timestamp, "frame_captured")
+            self.log_frame_timing(frame_index, timestamp_ns, "frame_captured")
             
-        except queue.Full:
-            # Try to clear old frames and retry once
-            try:
-                # Remove oldest frame to make room
-                _ = self.frame_queue.get_nowait()
-                # Retry putting the new frame
-                self.frame_queue.put_nowait(frame_data)
-                print(f"Replaced old frame with new frame {frame_index}")
-            except queue.Full:
-                # Still full, drop the frame
-                print(f"Frame {frame_index} dropped due to queue overflow")
+        except zmq.Again:
+            # Distribute thread has fallen behind, drop the frame. Counted rather than printed,
+            # since under overload this happens every frame.
+            self.frames_dropped += 1
+            self.log_counter("frames_dropped", self.frames_dropped, timestamp_ns)
     
     def handle_distribute_requests(self):
-        """Handle client requests for frames via ROUTER socket and process frames from queue"""
+        """Handle client requests via ROUTER, frames from the feed and inverted frames via PULL"""
         while self.running:
             try:
-                # Process frames from queue first
-                try:
-                    frame_data = self.frame_queue.get_nowait()
-                    
-                    # Store processed frame data with metadata
-                    self.current_frame_data = {
-                        'frame': frame_data['frame'],
-                        'frame_index': frame_data['frame_index']
-                    }
-                    
-                except queue.Empty:
-                    # No frames to process, continue to handle client requests
-                    pass
+                # Block until any socket is readable (timeout only to check running)
+                events = dict(self.distribute_poller.poll(100))
                 
-                # Poll for messages from clients with shorter timeout
-                if self.distribute_socket.poll(10):  # 10ms timeout for more responsiveness
-                    # Receive client identity and message
-                    client_id = self.distribute_socket.recv(zmq.NOBLOCK)
-                    message = self.distribute_socket.recv_string(zmq.NOBLOCK)
-                    
-                    if message == "READY":
-                        # Client is ready for a frame
-                        if hasattr(self, 'current_frame_data') and self.current_frame_data is not None and self.current_frame_data.get('frame_index') is not None:
-                            # Check if this is a new frame that hasn't been sent yet
-                            if self.current_frame_data['frame_index'] > self.last_frame_sent:
-                                try:
-                                    # Send frame index and frame data to client
-                                    self.distribute_socket.send(client_id, zmq.SNDMORE)
-                                    self.distribute_socket.send_string(str(self.current_frame_data['frame_index']), zmq.SNDMORE)
-                                    self.distribute_socket.send(self.current_frame_data['frame'], zmq.NOBLOCK)
-                                    
-                                    # Update tracking
-                                    self.last_frame_sent = self.current_frame_data['frame_index']
-                                    
-                                except zmq.Again:
-                                    print(f"Failed to send frame {self.current_frame_data.get('frame_index', 'unknown')} - socket buffer full")
+                if self.feed_in in events:
+                    # Drain all queued frames, keeping only the newest one
+                    while True:
+                        try:
+                            header, frame = self.feed_in.recv_multipart(zmq.NOBLOCK, copy=False)
+                        except zmq.Again:
+                            break
+                        
+                        # Store processed frame data with metadata; the header is forwarded as-is
+                        self.current_frame_data = {
+                            'frame': frame,
+                            'header': header,
+                            'frame_index': DISTRIBUTE_HEADER.unpack(header.bytes)[0]
+                        }
+                
+                if self.distribute_socket in events:
+                    # Drain all READY requests; each worker sends one per frame it can take
+                    while True:
+                        try:
+                            client_id, message, frames_received = self.distribute_socket.recv_multipart(zmq.NOBLOCK)
+                        except zmq.Again:
+                            break
+                        
+                        if message != READY or client_id in self.idle_workers:
+                            continue
+                        
+                        # A READY resent while a frame is still on its way to that worker is not a new credit
+                        if READY_HEADER.unpack(frames_received)[0] < self.frames_sent_to.get(client_id, 0):
+                            continue
+                        self.idle_workers.append(client_id)
+                
+                # Hand a new frame to the longest-waiting idle worker as soon as both exist
+                self.dispatch_frame()
+                
+                if self.collect_socket in events:
+                    self.check_inverter_output()
                 
             except zmq.Again:
                 # No message available, continue
@@ -250,116 +442,151 @@ class Distributor:
                 print(f"Error handling distribute request: {e}")
                 continue
     
+    def dispatch_frame(self):
+        """Send the current frame to an idle worker if it hasn't been sent yet"""
+        cfd = self.current_frame_data
+        if cfd is None or cfd['frame_index'] <= self.last_frame_sent:
+            return
+        
+        while self.idle_workers:
+            client_id = self.idle_workers.popleft()
+            try:
+                # Send frame index and frame data to client without copying the payload. The payload is the
+                # zmq.Frame received from the feed, which owns its own copy made when the frame was queued
+                # (add_frame_for_distribution sends with copying on), and is never written to afterwards.
+                # It is not frame_ring memory, so reusing ring slots or capture buffers can't change it mid-send.
+                self.distribute_socket.send_multipart([
+                    client_id,
+                    cfd['header'],
+                    cfd['frame']
+                ], zmq.NOBLOCK, copy=False)
+            except zmq.Again:
+                # Worker's pipe is still full: keep its credit and try again on the next wakeup
+                self.idle_workers.appendleft(client_id)
+                return
+            except zmq.ZMQError as e:
+                if e.errno == errno.EHOSTUNREACH:
+                    self.frames_sent_to.pop(client_id, None)
+                    continue  # Worker disconnected, try the next one
+                raise
+            
+            # Update tracking
+            self.last_frame_sent = cfd['frame_index']
+            self.frames_sent_to[client_id] = self.frames_sent_to.get(client_id, 0) + 1
+            return
+    
     def check_inverter_output(self):
-        """Check for inverted frames from inverter output queue and store in buffer"""
-        while self.running:
+        """Drain inverted frames from the collect socket and store them in the ring"""
+        while True:
             try:
-                # Poll for messages with shorter timeout
-                if self.collect_socket.poll(10):  # 10ms timeout for more responsiveness
-                    # Receive inverted frame from inverter
-                    frame_index = self.collect_socket.recv_string(zmq.NOBLOCK)
-                    process_id = self.collect_socket.recv_string(zmq.NOBLOCK)
-                    start_time = self.collect_socket.recv_string(zmq.NOBLOCK)
-                    end_time = self.collect_socket.recv_string(zmq.NOBLOCK)
-                    inverted_data = self.collect_socket.recv(zmq.NOBLOCK)
-                    
-                    # Log frame timing as complete event with duration
-                    self.log_frame_complete_timing(int(frame_index), float(start_time), float(end_time), "frame_inverted_received", int(process_id))
-                    
-                    # Store frame in buffer with metadata (don't reshape here - let the app handle it)
-                    frame_index_int = int(frame_index)
-                    self.received_frames[frame_index_int] = {
-                        'frame_data': inverted_data,  # Store raw bytes
-                        'process_id': process_id,
-                        'start_time': float(start_time),
-                        'end_time': float(end_time)
-                    }
-                    
-                    # Update latest received frame
-                    self.latest_received_frame = max(self.latest_received_frame, frame_index_int)
-                    
-                    # Clean up old frames from buffer
-                    self.cleanup_old_frames()
-                
+                # Receive inverted frame from inverter as a single multipart message.
+                # The payload stays a zero-copy zmq.Frame; only the small metadata header is unpacked.
+                header, inverted_frame = self.collect_socket.recv_multipart(zmq.NOBLOCK, copy=False)
             except zmq.Again:
-                # No message available, continue
-                continue
+                # No more messages queued
+                return
+            
+            try:
+                frame_index_int, process_id, start_ns, end_ns = COLLECT_HEADER.unpack(header.bytes)
+                inverted_data = inverted_frame.buffer  # memoryview, keeps the frame alive
+                
+                # Log frame timing as complete event with duration
+                self.log_frame_complete_timing(frame_index_int, start_ns, end_ns, "frame_inverted_received", process_id)
+                
+                # Store frame in its ring slot (don't reshape here - let the app handle it).
+                # Older frames are overwritten implicitly; a late frame never replaces a newer one.
+                slot = frame_index_int % self.ring_size
+                stored = frame_index_int > self.frame_ring_index[slot]
+                if stored:
+                    self.frame_ring[slot] = inverted_data  # Store raw payload (memoryview)
+                    self.frame_ring_index[slot] = frame_index_int
+                
+                # Update latest received frame
+                self.latest_received_frame = max(self.latest_received_frame, frame_index_int)
+                self.advance_display_ready(frame_index_int if stored else -1)
+                
             except Exception as e:
                 print(f"Error receiving inverted frame: {e}")
-                continue
     
-    def cleanup_old_frames(self):
-        """Remove frames from buffer that are older than current display frame"""
-        frames_to_remove = []
-        for frame_index in self.received_frames:
-            if frame_index < self.current_display_frame:
-                frames_to_remove.append(frame_index)
-        
-        for frame_index in frames_to_remove:
-            del self.received_frames[frame_index]
-        
-        # Also limit buffer size to prevent memory issues
-        if len(self.received_frames) > self.frame_buffer_size:
-            # Remove oldest frames when buffer is too large
-            sorted_frames = sorted(self.received_frames.keys())
-            frames_to_remove = sorted_frames[:len(sorted_frames) - self.frame_buffer_size]
-            for frame_index in frames_to_remove:
-                del self.received_frames[frame_index]
+    def buffered_frame_count(self):
+        """Count frames in the ring that have not been displayed yet"""
+        return sum(1 for frame_index in self.frame_ring_index if frame_index >= self.current_display_frame)
+    
+    def display_target(self):
+        """Frame the display aims for, frame_delay frames behind the latest received, or -1 if none yet"""
+        if self.latest_received_frame >= self.frame_delay:
+            # Calculate target frame (frame_delay frames behind latest); frames in between are skipped
+            return self.latest_received_frame - self.frame_delay
+        if self.latest_received_frame > 0:
+            # If we have some frames but not enough for the delay, advance to latest
+            return self.latest_received_frame
+        return -1
+    
+    def advance_display_ready(self, stored_frame):
+        """Update display_ready_frame after a frame arrives (stored_frame is -1 if it wasn't stored)"""
+        target_frame = self.display_target()
+        
+        # A late frame that fills a gap at or before the target
+        if self.display_ready_frame < stored_frame <= target_frame:
+            self.display_ready_frame = stored_frame
+        
+        # Check only the slots the target has moved past since the last call, newest first, so each frame
+        # index is looked at once overall. Gaps left by frames never processed are skipped.
+        if target_frame > self.display_target_scanned:
+            oldest = max(self.display_target_scanned + 1, target_frame - self.ring_size + 1)
+            for frame_index in range(target_frame, oldest - 1, -1):
+                if self.frame_ring_index[frame_index % self.ring_size] == frame_index:
+                    self.display_ready_frame = max(self.display_ready_frame, frame_index)
+                    break
+            self.display_target_scanned = target_frame
     
     def get_frame_to_display(self):
-        """Get the frame to display based on current display frame index"""
-        target_frame = self.current_display_frame
-        if target_frame in self.received_frames:
-            return self.received_frames[target_frame]['frame_data']  # Return raw bytes
-        else:
-            # Frame is missing, check if we have any frames to display
-            if self.received_frames:
-                # Find the closest available frame
-                available_frames = sorted(self.received_frames.keys())
-                if available_frames:
-                    closest_frame = min(available_frames, key=lambda x: abs(x - target_frame))
-                    return self.received_frames[closest_frame]['frame_data']  # Return raw bytes
-        return None
+        """Get the current display frame, or None if it was already returned or is no longer held"""
+        frame_index = self.current_display_frame
+        if frame_index == self.displayed_frame_index:
+            return None
+        slot = frame_index % self.ring_size
+        if self.frame_ring_index[slot] != frame_index:
+            return None
+        frame = self.frame_ring[slot]  # Raw payload
+        if self.frame_ring_index[slot] != frame_index:
+            return None  # Replaced by a newer frame while reading
+        self.displayed_frame_index = frame_index
+        return frame
     
     def update_display_frame(self):
-        """Update the current display frame based on latest received frame"""
-        if self.latest_received_frame >= self.frame_delay:
-            # Calculate target frame (frame_delay frames behind latest)
-            target_frame = self.latest_received_frame - self.frame_delay
-            
-            # Only advance if we have the target frame or if we're falling behind
-            if target_frame in self.received_frames or target_frame > self.current_display_frame:
-                self.current_display_frame = target_frame
-                return True
-            else:
-                # Frame is missing from buffer, count as dropped
-                # Still advance to prevent getting stuck
-                self.current_display_frame = target_frame
-                return True
-        elif self.latest_received_frame > 0:
-            # If we have some frames but not enough for the delay, advance to latest
-            if self.current_display_frame < self.latest_received_frame:
-                self.current_display_frame = self.latest_received_frame
-                return True
+        """Update the current display frame based on latest received frame, returning True only if it changed"""
+        # Advance only to a frame the ring actually holds: the newest at or before the target,
+        # tracked by the distribute thread as frames arrive
+        available_frame = self.display_ready_frame
+        if available_frame > self.current_display_frame:
+            self.current_display_frame = available_frame
+            return True
         return False
     
     def get_frame_stats(self):
         """Get current frame statistics for display"""
         return {
-            'buffer_size': len(self.received_frames),
+            'buffer_size': self.buffered_frame_count(),
             'current_display_frame': self.current_display_frame,
             'latest_received_frame': self.latest_received_frame,
             'frame_delay': self.frame_delay,
-            'total_frames_processed': self.frame_index_counter
+            'total_frames_processed': self.frame_index_counter,
+            'frames_dropped': self.frames_dropped
         }
     
     def cleanup(self):
         """Clean up ZeroMQ connections"""
         self.stop()
         
+        # Let the distribute thread leave its poll before its sockets are closed
+        self._join_thread(self.distribute_thread)
+        
         # Close ZeroMQ sockets
         self.distribute_socket.close()
         self.collect_socket.close()
+        self.feed_in.close()
+        self.feed_out.close()
         self.context.term()
         print("ZeroMQ connections closed")
         
@@ -367,10 +594,11 @@ class Distributor:
         print(f"Frame reordering statistics:")
         print(f"  Latest received frame: {self.latest_received_frame}")
         print(f"  Current display frame: {self.current_display_frame}")
-        print(f"  Frames in buffer: {len(self.received_frames)}")
+        print(f"  Frames in buffer: {self.buffered_frame_count()}")
         print(f"  Frame delay: {self.frame_delay} frames")
+        print(f"  Frames dropped: {self.frames_dropped}")
         
         # Export trace if not already done
-        if self.enable_trace_export and self.frame_timings:
+        if self.enable_trace_export:
             print("Exporting Perfetto trace on cleanup...")
             self.export_perfetto_trace() 
\ No newline at end of file
@@ -1,16 +1,21 @@
 import argparse
 from worker import Worker
-import cv2
 import numpy as np
+import math
 import time
 import signal
-from turbojpeg import TurboJPEG
+from turbojpeg import TurboJPEG, TJPF_RGB, TJSAMP_420
+
+# Constants
+JPEG_QUALITY = 75
 
 class InverterWorker(Worker):
     def __init__(self, host="localhost", distribute_port=5555, collect_port=5556, delay=0.0, use_jpeg=True):
         super().__init__(host, distribute_port, collect_port)
         self.delay = delay
         self.jpeg = TurboJPEG() if use_jpeg else None
+        self.output_buffer = None  # Reused inverted frame, reallocated only if the frame shape changes
+        self.encode_buffer = None  # Reused JPEG output, sized for the worst case of output_buffer
         
         # Set up signal handlers for clean shutdown
         signal.signal(signal.SIGINT, self._signal_handler)
@@ -27,23 +32,31 @@ class InverterWorker(Worker):
             self.running = False
     
     def __call__(self, frame_bytes):
-        """Invert the colors of the input frame"""
+        """Invert the colors of the input frame (RGB uint8 HWC)"""
         if self.jpeg:
-            frame = self.jpeg.decode(frame_bytes)
+            frame = self.jpeg.decode(frame_bytes, pixel_format=TJPF_RGB)
         else:
-            frame = np.frombuffer(frame_bytes, dtype=np.uint8).reshape(480, 480, 3)
+            # Raw frames are square RGB, so the side length follows from the payload size
+            size = math.isqrt(len(frame_bytes) // 3)
+            frame = np.frombuffer(frame_bytes, dtype=np.uint8).reshape(size, size, 3)
         
         # Apply artificial delay if specified
         if self.delay > 0:
             time.sleep(self.delay)
         
-        # Invert the image using bitwise NOT
-        inverted = cv2.bitwise_not(frame)
+        # Invert the image with an XOR into the reused output buffer
+        if self.output_buffer is None or self.output_buffer.shape != frame.shape:
+            self.output_buffer = np.empty_like(frame)
+            if self.jpeg:
+                self.encode_buffer = bytearray(self.jpeg.buffer_size(self.output_buffer, TJSAMP_420))
+        inverted = np.bitwise_xor(frame, np.uint8(255), out=self.output_buffer)
         
         if self.jpeg:
-            return self.jpeg.encode(inverted)
+            _, jpeg_size = self.jpeg.encode(inverted, quality=JPEG_QUALITY, pixel_format=TJPF_RGB,
+                                            jpeg_subsample=TJSAMP_420, dst=self.encode_buffer)
+            return memoryview(self.encode_buffer)[:jpeg_size]  # Sent zero-copy; the worker waits for it before the next call
         else:
-            return inverted.tobytes()
+            return inverted  # Sent zero-copy, like the JPEG path
     
 def main():
     # Parse command line arguments using argparse
@@ -54,10 +67,12 @@ def main():
                        help='Port to send inverted frames to webcam app (default: 5556)')
     parser.add_argument('--delay', type=float, default=0.0,
                        help='Artificial processing delay in seconds (default: 0.0)')
+    parser.add_argument('--use-jpeg', action=argparse.BooleanOptionalAction, default=True,
+                       help='Expect and return JPEG frames; must match the webcam app (default: True)')
     
     args = parser.parse_args()
     
-    worker = InverterWorker("localhost", args.distribute_port, args.collect_port, args.delay)
+    worker = InverterWorker("localhost", args.distribute_port, args.collect_port, args.delay, args.use_jpeg)
     worker.start()
 
 if __name__ == "__main__":
@@ -0,0 +1,40 @@
+import getpass
+import os
+import struct
+import tempfile
+import zmq
+
+# Fixed-size binary headers sent ahead of each frame payload, so metadata
+# never has to be formatted or parsed as strings on the hot path.
+
+# Worker -> distributor request for the next frame, followed by frames_received
+READY = b"READY"
+READY_HEADER = struct.Struct("<q")
+
+# Distributor -> worker: frame_index
+DISTRIBUTE_HEADER = struct.Struct("<i")
+
+# Worker -> distributor: frame_index, process_id, start_ns, end_ns
+COLLECT_HEADER = struct.Struct("<iiqq")
+
+# Workers on the same host as the distributor connect over Unix domain
+# sockets instead of loopback TCP; the distributor listens on both.
+# The transport is chosen once, when a worker connects: a worker started
+# before its distributor stays on TCP until it is restarted.
+LOCAL_HOSTS = ("localhost", "127.0.0.1")
+
+def ipc_path(port):
+    """Filesystem path of the Unix domain socket paired with a TCP port, private to the current user"""
+    runtime_dir = os.environ.get("XDG_RUNTIME_DIR")
+    if runtime_dir:
+        return os.path.join(runtime_dir, f"dvf-{port}")
+    user = os.getuid() if hasattr(os, "getuid") else getpass.getuser()
+    return os.path.join(tempfile.gettempdir(), f"dvf-{user}-{port}")
+
+def ipc_endpoint(port):
+    """Unix domain socket endpoint paired with a TCP port"""
+    return f"ipc://{ipc_path(port)}"
+
+def use_ipc(host, port):
+    """Whether a worker connecting to host can use the ipc endpoint (only if the distributor bound it)"""
+    return host in LOCAL_HOSTS and zmq.has("ipc") and os.path.exists(ipc_path(port))
@@ -1,28 +1,45 @@
 import cv2
+import ctypes
+import os
+import sys
+import numpy as np
 import pyglet
 from pyglet.gl import *
 import threading
 import time
+from collections import deque
 import signal
 import argparse
 from distributor import Distributor
-from turbojpeg import TurboJPEG
+from turbojpeg import TurboJPEG, TJPF_RGB, TJSAMP_420
 
 # Constants
 CAPTURE_WIDTH = 1280
 CAPTURE_HEIGHT = 720
 CAMERA_FPS = 30
+JPEG_QUALITY = 75  # 4:2:0 at this quality is plenty for the workers
+FPS_SAMPLE_MASK = 31  # Read the clock for FPS reporting only every 32 frames
+FPS_REPORT_INTERVAL_NS = 5_000_000_000
+PIXEL_BUFFER_COUNT = 2  # Pixel buffers per texture, so an upload can overlap the next frame's copy
+RGB_BUFFER_COUNT = 6  # Converted frames in flight: capture, display and the encoder; capture skips frames when none is free
+CAPTURE_CPU = 0  # CPUs used by --pin-cpus
+ENCODE_CPU = 1
+RENDER_CPU = 2
 
 class WebcamApp(Distributor):
-    def __init__(self, distribute_port=5555, collect_port=5556, frame_delay=5, target_size=512, use_jpeg=True):
+    def __init__(self, distribute_port=5555, collect_port=5556, frame_delay=5, target_size=512, use_jpeg=True, pin_cpus=False, enable_trace_export=False):
         # Initialize parent Distributor class with configurable frame delay
-        super().__init__(distribute_port, collect_port, frame_delay)
+        super().__init__(distribute_port, collect_port, frame_delay, enable_trace_export)
         
         # Store target size for frame processing
         self.target_size = target_size
+        self.pin_cpus = pin_cpus
         
         self.jpeg = TurboJPEG() if use_jpeg else None
         
+        # Reused destination for decoding processed frames
+        self.decode_buffer = np.empty((self.target_size, self.target_size, 3), dtype=np.uint8)
+        
         # Pyglet window setup
         self.window = pyglet.window.Window(
             width=self.target_size * 2,  # Double width to accommodate both frames
@@ -30,18 +47,37 @@ class WebcamApp(Distributor):
             caption='Webcam Feed'
         )
         
+        # Persistent display textures, updated in place each frame
+        self.texture = self._create_texture()
+        self.processed_texture = self._create_texture()
+        self.texture_pixel_buffers = self._create_pixel_buffers()
+        self.processed_texture_pixel_buffers = self._create_pixel_buffers()
+        self.texture_ready = False
+        self.processed_texture_ready = False
+        self.bad_processed_frames = 0  # Worker results dropped because they couldn't be shown
+        
         # Camera and frame data
-        self.frame_data = None
-        self.texture = None
-        self.processed_texture = None
         self.cap = None
-        self.new_frame_available = False
+        
+        # Converted frames go into a pool of buffers. Each is held by the display and, in JPEG mode, the encoder,
+        # and only returns to the free list once both have released it, so it is never overwritten while read.
+        self.rgb_buffers = [np.empty((self.target_size, self.target_size, 3), dtype=np.uint8) for _ in range(RGB_BUFFER_COUNT)]
+        self.rgb_buffer_holds = [0] * RGB_BUFFER_COUNT
+        self.free_rgb_buffers = deque(range(RGB_BUFFER_COUNT))
+        self.rgb_buffer_lock = threading.Lock()
+        self.new_frame_buffer = None  # Index of the newest converted frame not yet taken by on_draw
+        self.capture_frames_skipped = 0  # Frames skipped because every buffer was still held
+        
+        # MJPEG capture decoding, set up on the first compressed frame
+        self.capture_jpeg = None
+        self.capture_buffer = None
+        self.capture_decode_errors = 0  # Corrupt or truncated MJPEG frames skipped
         
         # Frame rate monitoring
         self.capture_fps_counter = 0
-        self.capture_fps_start_time = time.time()
+        self.capture_fps_start_time = time.monotonic_ns()
         self.draw_fps_counter = 0
-        self.draw_fps_start_time = time.time()
+        self.draw_fps_start_time = time.monotonic_ns()
         
         # Set up signal handlers for Ctrl+C
         signal.signal(signal.SIGINT, self._signal_handler)
@@ -54,19 +90,93 @@ class WebcamApp(Distributor):
         # Start distributor threads
         self.start()
         
+        # Start JPEG encoding thread, so encoding for the network never holds up capture or preview.
+        # The encoder takes only the newest queued frame and releases the rest unencoded, so falling
+        # behind never means more work. Single producer, single consumer.
+        self.encode_queue = deque()
+        self.encode_ready = threading.Event()
+        if self.jpeg:
+            self.encode_thread = threading.Thread(target=self.encode_frames)
+            self.encode_thread.daemon = True
+            self.encode_thread.start()
+        
         # Start frame reading thread
         self.frame_thread = threading.Thread(target=self.read_frames)
         self.frame_thread.daemon = True
         self.frame_thread.start()
     
+    def _create_texture(self):
+        """Allocate an RGB texture of the target size"""
+        return pyglet.image.Texture.create(self.target_size, self.target_size, internalformat=GL_RGB8, fmt=GL_RGB)
+    
+    def _create_pixel_buffers(self):
+        """Allocate pixel unpack buffers for streaming frames into a texture"""
+        buffer_ids = (GLuint * PIXEL_BUFFER_COUNT)()
+        glGenBuffers(PIXEL_BUFFER_COUNT, buffer_ids)
+        return list(buffer_ids)
+    
+    def _upload_texture(self, texture, pixel_buffers, frame):
+        """Copy a C-contiguous RGB uint8 frame into an existing texture via the next pixel buffer, returning False if it is the wrong size"""
+        size = self.target_size * self.target_size * 3
+        if frame.nbytes != size:
+            return False  # Copying it would read past the end of the frame
+        
+        # Rotate to the buffer least recently handed to the GPU
+        pixel_buffer = pixel_buffers.pop(0)
+        pixel_buffers.append(pixel_buffer)
+        
+        # Orphan the buffer's previous storage so mapping never waits on an upload in flight
+        glBindBuffer(GL_PIXEL_UNPACK_BUFFER, pixel_buffer)
+        glBufferData(GL_PIXEL_UNPACK_BUFFER, size, None, GL_STREAM_DRAW)
+        pointer = glMapBufferRange(GL_PIXEL_UNPACK_BUFFER, 0, size, GL_MAP_WRITE_BIT | GL_MAP_INVALIDATE_BUFFER_BIT)
+        if pointer:
+            ctypes.memmove(pointer, frame.ctypes.data, size)
+        glUnmapBuffer(GL_PIXEL_UNPACK_BUFFER)
+        
+        # With a pixel buffer bound, the texture update is sourced from it asynchronously
+        glBindTexture(texture.target, texture.id)
+        glPixelStorei(GL_UNPACK_ALIGNMENT, 1)
+        glTexSubImage2D(texture.target, 0, 0, 0, self.target_size, self.target_size,
+                        GL_RGB, GL_UNSIGNED_BYTE, None)
+        glBindBuffer(GL_PIXEL_UNPACK_BUFFER, 0)
+        return True
+    
+    def _blit_flipped(self, texture, x):
+        """Draw a texture at x, flipped on both axes (rows are uploaded top-first, mirrored for display)"""
+        texture.blit(x + self.target_size, self.target_size, width=-self.target_size, height=-self.target_size)
+    
+    def _pin_current_thread(self, cpu):
+        """Pin the calling thread to a single CPU when --pin-cpus is set (Linux only)"""
+        if self.pin_cpus and hasattr(os, 'sched_setaffinity'):
+            os.sched_setaffinity(0, {cpu % os.cpu_count()})
+    
+    def _release_rgb_buffer(self, index):
+        """Drop one hold on a converted frame buffer, returning it to the free list once nobody holds it"""
+        with self.rgb_buffer_lock:
+            self.rgb_buffer_holds[index] -= 1
+            if self.rgb_buffer_holds[index] == 0:
+                self.free_rgb_buffers.append(index)
+    
     def _signal_handler(self, signum, frame):
         print(f"\nReceived signal {signum}")
         self.cleanup()
         pyglet.app.exit()
     
     def read_frames(self):
+        self._pin_current_thread(CAPTURE_CPU)
         print("Starting OpenCV video capture...")
-        self.cap = cv2.VideoCapture(0)
+        if sys.platform.startswith('linux'):
+            # Talk to V4L2 directly and take the camera's MJPEG stream undecoded; TurboJPEG turns it
+            # straight into RGB, and MJPEG needs far less USB bandwidth than YUYV at full resolution
+            self.cap = cv2.VideoCapture(0, cv2.CAP_V4L2)
+            capture_fourcc = 'MJPG'
+        else:
+            # Elsewhere ask for packed YUYV, so one cvtColor goes straight to RGB
+            self.cap = cv2.VideoCapture(0)
+            capture_fourcc = 'YUYV'
+        
+        # Format first: V4L2 drivers may reset the size and rate when it changes
+        self.cap.set(cv2.CAP_PROP_FOURCC, cv2.VideoWriter_fourcc(*capture_fourcc))
         self.cap.set(cv2.CAP_PROP_FPS, CAMERA_FPS)
         self.cap.set(cv2.CAP_PROP_FRAME_WIDTH, CAPTURE_WIDTH)
         self.cap.set(cv2.CAP_PROP_FRAME_HEIGHT, CAPTURE_HEIGHT)
@@ -74,94 +184,189 @@ class WebcamApp(Distributor):
         # Set buffer size to minimize latency
         self.cap.set(cv2.CAP_PROP_BUFFERSIZE, 1)
         
+        # Skip OpenCV's BGR conversion. Backends that ignore the format request keep delivering BGR,
+        # which _to_rgb also handles.
+        self.cap.set(cv2.CAP_PROP_CONVERT_RGB, 0)
+        
         if not self.cap.isOpened():
             print("Error: Could not open camera")
             self.running = False
             return
         
+        # Reuse one capture buffer; OpenCV writes each new frame into it when the size matches
+        frame = None
+        
         while self.running:
-            ret, frame = self.cap.read()
+            ret, frame = self.cap.read(frame)
             if not ret:
                 print("Error: Can't receive frame")
                 break
             
+            # Wall-clock capture time in integer nanoseconds, on the same timeline as the workers' spans.
+            # Only the trace uses it, so the clock is skipped entirely when tracing is off.
+            current_time = time.time_ns() if self.enable_trace_export else None
+            
             # Update capture FPS counter
-            current_time = time.time()
             self.capture_fps_counter += 1
-            if current_time - self.capture_fps_start_time >= 5.0:
-                capture_fps = self.capture_fps_counter / (current_time - self.capture_fps_start_time)
-                print(f"Capture FPS: {capture_fps:.1f}")
-                self.capture_fps_counter = 0
-                self.capture_fps_start_time = current_time
+            if self.capture_fps_counter & FPS_SAMPLE_MASK == 0:
+                now = time.monotonic_ns()
+                if now - self.capture_fps_start_time >= FPS_REPORT_INTERVAL_NS:
+                    capture_fps = self.capture_fps_counter * 1e9 / (now - self.capture_fps_start_time)
+                    print(f"Capture FPS: {capture_fps:.1f} ({self.capture_decode_errors} corrupt, {self.capture_frames_skipped} without a free buffer skipped)")
+                    self.log_counter("capture_fps", capture_fps, current_time)
+                    self.log_counter("capture_decode_errors", self.capture_decode_errors, current_time)
+                    self.capture_fps_counter = 0
+                    self.capture_fps_start_time = now
+            
+            if frame.ndim != 3 and not self._is_jpeg(frame):
+                # Raw output in a layout we can't crop: fall back to OpenCV's BGR conversion
+                print("Camera returned unconverted data, enabling BGR conversion")
+                self.cap.set(cv2.CAP_PROP_CONVERT_RGB, 1)
+                frame = None
+                continue
+            
+            # Take a buffer nobody is reading; if display and encoding still hold them all, skip this frame
+            try:
+                rgb_index = self.free_rgb_buffers.popleft()
+            except IndexError:
+                self.capture_frames_skipped += 1
+                continue
             
-            # Center crop to target_size x target_size
-            h, w, _ = frame.shape
-            crop_x = (w - self.target_size) // 2
-            crop_y = (h - self.target_size) // 2
-            frame_cropped = frame[crop_y:crop_y+self.target_size, crop_x:crop_x+self.target_size]
-            frame_rgb = cv2.cvtColor(frame_cropped, cv2.COLOR_BGR2RGB)
+            # Center crop to target_size x target_size and convert to RGB
+            try:
+                frame_rgb = self._to_rgb(frame, self.rgb_buffers[rgb_index])
+            except OSError:
+                # Webcams do deliver truncated or corrupt MJPEG frames; TurboJPEG raises on them, so skip the frame
+                self.capture_decode_errors += 1
+                self.free_rgb_buffers.append(rgb_index)
+                continue
             
-            # Store processed frame data for display
-            self.frame_data = frame_rgb
-            self.new_frame_available = True
+            # Held by the display and, in JPEG mode, the encoder
+            self.rgb_buffer_holds[rgb_index] = 2 if self.jpeg else 1
             
             # Send frame to distributor for distribution to workers
             if self.jpeg:
-                frame_bytes = self.jpeg.encode(frame_rgb)
-                self.add_frame_for_distribution(frame_bytes, current_time)
+                self.encode_queue.append((rgb_index, current_time))
+                self.encode_ready.set()
             else:
-                self.add_frame_for_distribution(frame_rgb.tobytes(), current_time)
+                # Pass the array itself; the feed socket copies it once, before the buffer can be reused
+                self.add_frame_for_distribution(frame_rgb, current_time)
+            
+            # Hand the frame to the display; a newer frame replaces one on_draw hasn't taken yet
+            with self.rgb_buffer_lock:
+                replaced, self.new_frame_buffer = self.new_frame_buffer, rgb_index
+            if replaced is not None:
+                self._release_rgb_buffer(replaced)
         
         self.cap.release()
         print("Camera released.")
     
+    def _is_jpeg(self, frame):
+        """Whether an unconverted capture buffer holds a JPEG image (starts with the SOI marker)"""
+        return frame.size >= 2 and frame.flat[0] == 0xFF and frame.flat[1] == 0xD8
+    
+    def _decode_capture(self, frame):
+        """Decode a captured MJPEG frame into a reused full-size RGB buffer"""
+        if self.capture_jpeg is None:
+            self.capture_jpeg = TurboJPEG()
+        width, height, _, _ = self.capture_jpeg.decode_header(frame)
+        if self.capture_buffer is None or self.capture_buffer.shape[:2] != (height, width):
+            self.capture_buffer = np.empty((height, width, 3), dtype=np.uint8)
+        return self.capture_jpeg.decode(frame, pixel_format=TJPF_RGB, dst=self.capture_buffer)
+    
+    def _to_rgb(self, frame, dst):
+        """Center crop a captured MJPEG, YUYV (HxWx2) or BGR (HxWx3) frame and convert it to RGB in dst"""
+        if frame.ndim != 3:
+            frame = self._decode_capture(frame)
+        h, w = frame.shape[:2]
+        crop_x = ((w - self.target_size) // 2) & ~1  # Even, so YUYV pixel pairs stay intact
+        crop_y = (h - self.target_size) // 2
+        frame_cropped = frame[crop_y:crop_y+self.target_size, crop_x:crop_x+self.target_size]  # View, no copy
+        if frame is self.capture_buffer:
+            np.copyto(dst, frame_cropped)
+            return dst
+        if frame.shape[2] == 2:
+            return cv2.cvtColor(frame_cropped, cv2.COLOR_YUV2RGB_YUYV, dst=dst)
+        return cv2.cvtColor(frame_cropped, cv2.COLOR_BGR2RGB, dst=dst)
+    
+    def encode_frames(self):
+        """Encode captured frames as JPEG and hand them to the distributor"""
+        self._pin_current_thread(ENCODE_CPU)
+        
+        # Reused output buffer sized for the worst-case JPEG; the feed socket copies out of it on send
+        frame_shape = (self.target_size, self.target_size, 3)
+        encode_buffer = bytearray(self.jpeg.buffer_size(np.empty(frame_shape, dtype=np.uint8), TJSAMP_420))
+        
+        while self.running:
+            if not self.encode_ready.wait(0.1):
+                continue
+            # Clear before draining, so a frame appended meanwhile sets the event again
+            self.encode_ready.clear()
+            newest = None
+            while self.encode_queue:
+                if newest is not None:
+                    self._release_rgb_buffer(newest[0])  # Stale; a newer frame is queued behind it
+                newest = self.encode_queue.popleft()
+            if newest is not None:
+                rgb_index, timestamp = newest
+                _, frame_size = self.jpeg.encode(self.rgb_buffers[rgb_index], quality=JPEG_QUALITY, pixel_format=TJPF_RGB,
+                                                 jpeg_subsample=TJSAMP_420, dst=encode_buffer)
+                self._release_rgb_buffer(rgb_index)
+                self.add_frame_for_distribution(memoryview(encode_buffer)[:frame_size], timestamp)
+    
     def on_draw(self):
         self.window.clear()
         
-        # Update live feed texture if we have new frame data
-        if self.frame_data is not None and self.new_frame_available:
-            image_data = pyglet.image.ImageData(
-                self.target_size, self.target_size, 'RGB', 
-                self.frame_data.tobytes()
-            )
-            self.texture = image_data.get_texture().get_transform(flip_y=True, flip_x=True)
-            self.texture.anchor_x = 0
-            self.texture.anchor_y = 0
-            self.new_frame_available = False
+        # Update live feed texture if we have new frame data, holding its buffer until the copy is done
+        with self.rgb_buffer_lock:
+            rgb_index, self.new_frame_buffer = self.new_frame_buffer, None
+        if rgb_index is not None:
+            self._upload_texture(self.texture, self.texture_pixel_buffers, self.rgb_buffers[rgb_index])
+            self._release_rgb_buffer(rgb_index)
+            self.texture_ready = True
         
-        if self.texture:
-            self.texture.blit(0, 0, width=self.target_size, height=self.target_size)
+        if self.texture_ready:
+            self._blit_flipped(self.texture, 0)
         
         frame_updated = self.update_display_frame()
         if frame_updated:
             frame_data_bytes = self.get_frame_to_display()
             if frame_data_bytes is not None:
                 if self.jpeg:
-                    frame_data_bytes = self.jpeg.decode(frame_data_bytes).tobytes()
-                image_data = pyglet.image.ImageData(
-                    self.target_size, self.target_size, 'RGB', 
-                    frame_data_bytes
-                )
-                self.processed_texture = image_data.get_texture().get_transform(flip_y=True, flip_x=True)
-                self.processed_texture.anchor_x = 0
-                self.processed_texture.anchor_y = 0
+                    try:
+                        processed_frame = self.jpeg.decode(frame_data_bytes, pixel_format=TJPF_RGB, dst=self.decode_buffer)
+                    except (OSError, ValueError):
+                        # Corrupt JPEG (OSError) or a size other than decode_buffer's (ValueError); skip it
+                        processed_frame = None
+                else:
+                    # Received frames are zero-copy memoryviews; view them as an array without copying
+                    processed_frame = np.frombuffer(frame_data_bytes, dtype=np.uint8)
+                if processed_frame is not None and self._upload_texture(self.processed_texture, self.processed_texture_pixel_buffers, processed_frame):
+                    self.processed_texture_ready = True
+                else:
+                    # An undecodable, short or malformed worker result, e.g. from a worker with another --target-size
+                    self.bad_processed_frames += 1
             
-        if self.processed_texture:
-            self.processed_texture.blit(self.target_size, 0, width=self.target_size, height=self.target_size)
+        if self.processed_texture_ready:
+            self._blit_flipped(self.processed_texture, self.target_size)
             
         # Update draw FPS counter
         self.draw_fps_counter += 1
-        current_time = time.time()
-        if current_time - self.draw_fps_start_time >= 5.0:
-            draw_fps = self.draw_fps_counter / (current_time - self.draw_fps_start_time)
-            print(f"Draw FPS: {draw_fps:.1f}")
-            
-            # Get frame statistics from distributor
-            stats = self.get_frame_stats()
-            print(f"Frame buffer: {stats['buffer_size']} frames, current display: {stats['current_display_frame']}, latest received: {stats['latest_received_frame']}, total processed: {stats['total_frames_processed']}")
-            
-            self.draw_fps_counter = 0
-            self.draw_fps_start_time = current_time
+        if self.draw_fps_counter & FPS_SAMPLE_MASK == 0:
+            now = time.monotonic_ns()
+            if now - self.draw_fps_start_time >= FPS_REPORT_INTERVAL_NS:
+                draw_fps = self.draw_fps_counter * 1e9 / (now - self.draw_fps_start_time)
+                print(f"Draw FPS: {draw_fps:.1f} ({self.bad_processed_frames} bad processed frames dropped)")
+                
+                # Get frame statistics from distributor
+                stats = self.get_frame_stats()
+                print(f"Frame buffer: {stats['buffer_size']} frames, current display: {stats['current_display_frame']}, latest received: {stats['latest_received_frame']}, total processed: {stats['total_frames_processed']}, dropped: {stats['frames_dropped']}")
+                self.log_counter("draw_fps", draw_fps)
+                self.log_counter("frame_buffer", stats['buffer_size'])
+                self.log_counter("bad_processed_frames", self.bad_processed_frames)
+                
+                self.draw_fps_counter = 0
+                self.draw_fps_start_time = now
     
     def on_key_press(self, symbol, modifiers):
         if symbol == pyglet.window.key.ESCAPE:
@@ -172,7 +377,13 @@ class WebcamApp(Distributor):
     def cleanup(self):
         """Clean up camera and call parent cleanup"""
         self.running = False
-        if self.cap is not None:
+        
+        # Capture and encode threads send on the feed socket, so wait for them before it is closed.
+        # read_frames releases the camera itself once it exits.
+        self._join_thread(self.frame_thread)
+        if self.jpeg:
+            self._join_thread(self.encode_thread)
+        if self.cap is not None and self.frame_thread.is_alive():
             self.cap.release()
             print("Camera released.")
         
@@ -180,6 +391,7 @@ class WebcamApp(Distributor):
         super().cleanup()
     
     def run(self):
+        self._pin_current_thread(RENDER_CPU)
         print("Starting webcam application...")
         print("Press 'ESC' to quit")
         pyglet.app.run()
@@ -195,12 +407,16 @@ def main():
                        help='Frame delay for processing (default: 5)')
     parser.add_argument('--target-size', type=int, default=512,
                        help='Target size for frame processing (default: 512)')
-    parser.add_argument('--use-jpeg', type=bool, default=True,
-                       help='Use JPEG encoding for frames (default: True)')
+    parser.add_argument('--use-jpeg', action=argparse.BooleanOptionalAction, default=True,
+                       help='Use JPEG encoding for frames; --no-use-jpeg sends raw RGB (default: True)')
+    parser.add_argument('--pin-cpus', action='store_true',
+                       help='Pin the capture, encode and render threads to separate CPUs (Linux only)')
+    parser.add_argument('--trace', action='store_true',
+                       help='Record frame timings and counters, written to a Perfetto trace on exit')
     
     args = parser.parse_args()
     
-    app = WebcamApp(args.distribute_port, args.collect_port, args.frame_delay, args.target_size)
+    app = WebcamApp(args.distribute_port, args.collect_port, args.frame_delay, args.target_size, args.use_jpeg, args.pin_cpus, args.trace)
     app.run()
 
 if __name__ == "__main__":
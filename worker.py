@@ -1,6 +1,10 @@
 import zmq
 import time
 import os
+from protocol import DISTRIBUTE_HEADER, COLLECT_HEADER, READY, READY_HEADER, ipc_endpoint, use_ipc
+
+READY_RESEND_INTERVAL = 1.0  # Seconds without a frame before repeating a READY request
+SEND_WAIT_TIMEOUT = 0.1  # Seconds per wait on the previous send, between checks of running
 
 class Worker:
     def __init__(self, host="localhost", distribute_port=5555, collect_port=5556):
@@ -15,58 +19,119 @@ class Worker:
         
         # Initialize ZeroMQ context and sockets
         self.context = zmq.Context()
+        self.context.setsockopt(zmq.LINGER, 0)  # Don't hold up shutdown on unsent results
         
         # DEALER socket to request frames from webcam app
         self.dealer_socket = self.context.socket(zmq.DEALER)
-        self.dealer_socket.connect(f"tcp://{self.host}:{distribute_port}")
+        self.dealer_socket.setsockopt(zmq.RCVHWM, 1)  # Don't queue up frames that will be stale by the time we get to them
+        self.dealer_socket.setsockopt(zmq.IMMEDIATE, 1)  # Only queue READY on a completed connection
+        self._connect(self.dealer_socket, distribute_port)
         
         # PUSH socket to send inverted frames back to webcam app
         self.collect_socket = self.context.socket(zmq.PUSH)
-        self.collect_socket.connect(f"tcp://{self.host}:{collect_port}")
+        self.collect_socket.setsockopt(zmq.SNDHWM, 2)
+        self.collect_socket.setsockopt(zmq.IMMEDIATE, 1)  # Never buffer results for a distributor that isn't connected
+        self._connect(self.collect_socket, collect_port)
+        
+        # Poller for frame replies, created once rather than on every poll
+        self.poller = zmq.Poller()
+        self.poller.register(self.dealer_socket, zmq.POLLIN)
+        
+        # Tracks the last zero-copy result send, so its buffer isn't reused while libzmq still reads it
+        self.send_tracker = None
+        
+        # Frame rate monitoring
+        self.fps_counter = 0
+        self.fps_start_time = time.monotonic()
+        self.send_failures = 0  # Results dropped because the collect socket was full, reported with the rate
         
         print(f"Worker started on ports {distribute_port} (request) and {collect_port} (send)")
         print(f"Process ID: {self.process_id}")
     
+    def _connect(self, socket, port):
+        """Connect to a distributor port, over ipc when the distributor has bound it on this host"""
+        if use_ipc(self.host, port):
+            try:
+                socket.connect(ipc_endpoint(port))
+                return
+            except zmq.ZMQError as e:
+                print(f"ipc endpoint unavailable ({e}), connecting over tcp")
+        socket.connect(f"tcp://{self.host}:{port}")
+    
     def start(self):
         """Start the worker"""
         self.running = True
         print("Worker is running...")
         
+        # Bind loop invariants to locals once instead of looking them up on every frame
+        dealer_socket = self.dealer_socket
+        collect_socket = self.collect_socket
+        poll = self.poller.poll
+        unpack_header = DISTRIBUTE_HEADER.unpack
+        pack_header = COLLECT_HEADER.pack
+        pack_ready = READY_HEADER.pack
+        process_id = self.process_id
+        
+        # Each READY is a credit for one frame: sent at start and after every result, and
+        # resent only if no frame arrives for a while (e.g. the distributor restarted).
+        # It carries the number of frames received, so the distributor can ignore a resend
+        # that crossed a frame already on its way.
+        ready_pending = False
+        ready_sent_time = 0.0
+        frames_received = 0
+        
         while self.running:
             try:
-                # Send READY message to request a frame
-                try:
-                    self.dealer_socket.send_string("READY", zmq.NOBLOCK)
-                except zmq.Again:
-                    # Socket buffer full, wait a bit
-                    time.sleep(0.001)
-                    continue
+                if not ready_pending or time.monotonic() - ready_sent_time > READY_RESEND_INTERVAL:
+                    # Send READY message to request a frame
+                    try:
+                        dealer_socket.send_multipart([READY, pack_ready(frames_received)], zmq.NOBLOCK)
+                    except zmq.Again:
+                        # Socket buffer full, wait until it is writable again
+                        dealer_socket.poll(10, zmq.POLLOUT)
+                        continue
+                    ready_pending = True
+                    ready_sent_time = time.monotonic()
                 
-                # Poll for response with timeout
-                if self.dealer_socket.poll(10):  # 10ms timeout
-                    start_time = time.time()
+                # Wait for a frame; the timeout only bounds how often running is checked
+                if poll(100):
+                    ready_pending = False
+                    start_ns = time.time_ns()
                     
-                    # Receive frame index and frame data from webcam app
-                    frame_index = self.dealer_socket.recv_string(zmq.NOBLOCK)
-                    frame_bytes = self.dealer_socket.recv(zmq.NOBLOCK)
+                    # Receive frame index header and frame data from webcam app in one call,
+                    # handing the payload to __call__ as a memoryview over the received message
+                    header, frame = dealer_socket.recv_multipart(zmq.NOBLOCK, copy=False)
+                    frames_received += 1
+                    frame_index, = unpack_header(header.buffer)
+                    frame_bytes = frame.buffer
                     
-                    # Print frame index
-                    print(f"Processing frame {frame_index}")
+                    # Wait for the previous result to leave the socket, since __call__ may reuse its buffer.
+                    # If the distributor has stalled and we are asked to stop meanwhile, drop this frame.
+                    if not self._wait_for_send():
+                        break
                     
                     # Process the frame using the worker's __call__ method
                     processed_frame = self(frame_bytes)
                     
-                    end_time = time.time()
+                    end_ns = time.time_ns()
                     
-                    # Send processed frame, frame index, and process ID back to webcam app
+                    # Send metadata header (frame index, process ID, timings) and processed frame back to webcam app
                     try:
-                        self.collect_socket.send_string(frame_index, zmq.SNDMORE | zmq.NOBLOCK)
-                        self.collect_socket.send_string(str(self.process_id), zmq.SNDMORE | zmq.NOBLOCK)
-                        self.collect_socket.send_string(str(start_time), zmq.SNDMORE | zmq.NOBLOCK)
-                        self.collect_socket.send_string(str(end_time), zmq.SNDMORE | zmq.NOBLOCK)
-                        self.collect_socket.send(processed_frame, zmq.NOBLOCK)
+                        header = pack_header(frame_index, process_id, start_ns, end_ns)
+                        self.send_tracker = collect_socket.send_multipart(
+                            [header, processed_frame], zmq.NOBLOCK, copy=False, track=True)
                     except zmq.Again:
-                        print(f"Failed to send processed frame {frame_index} - socket buffer full")
+                        # Counted rather than printed, since under backpressure this happens every frame
+                        self.send_failures += 1
+                    
+                    # Report processing rate every 5 seconds instead of printing every frame
+                    self.fps_counter += 1
+                    now = time.monotonic()
+                    if now - self.fps_start_time >= 5.0:
+                        print(f"Processing {self.fps_counter / (now - self.fps_start_time):.1f} frames/s (last frame {frame_index}, {self.send_failures} unsent)")
+                        self.fps_counter = 0
+                        self.send_failures = 0
+                        self.fps_start_time = now
                 
             except zmq.Again:
                 # No message available, continue
@@ -75,6 +140,18 @@ class Worker:
                 print(f"Error in worker: {e}")
                 continue
     
+    def _wait_for_send(self):
+        """Wait for the previous zero-copy send to complete, returning False if stopped first"""
+        tracker = self.send_tracker
+        while tracker is not None and not tracker.done:
+            if not self.running:
+                return False
+            try:
+                tracker.wait(SEND_WAIT_TIMEOUT)
+            except zmq.NotDone:
+                pass
+        return True
+    
     def __call__(self, frame):
-        """Process the input frame - to be implemented by subclasses"""
+        """Process the input frame - to be implemented by subclasses (the result is sent zero-copy and may be reused by the next call)"""
         raise NotImplementedError("Subclasses must implement __call__ method")